@@ -1,12 +1,47 @@
+import argparse
 import glob
 import os
 import subprocess
 import sys
+import traceback
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
 
 import yaml
 
 from conda_forge_admin_requests import get_actions, register_actions
+from conda_forge_admin_requests.utils import (
+    EXCLUSIVE_LOCK,
+    RateLimitDeferred,
+    github_low_priority,
+)
+
+# Number of request files processed at the same time by `run`. `check` is
+# sequential unless `--jobs` is passed.
+DEFAULT_JOBS = 4
+
+# Upper bound on the number of requests of a given action running at the same
+# time. The conda-smithy based actions spawn several subprocesses per feedstock,
+# so they are kept sequential by default.
+DEFAULT_ACTION_LIMITS = {
+    "token_reset": 1,
+    "travis": 1,
+    "cirun": 1,
+    "blacksmith": 1,
+    "cirrus_runners": 1,
+    "namespace": 1,
+    "depot": 1,
+}
+
+
+class _Task(NamedTuple):
+    filename: str
+    action: str
+    request: dict
+    locks: frozenset
+    retry: bool
 
 
 def _get_task_files():
@@ -15,7 +50,52 @@ def _get_task_files():
     )
 
 
-def check():
+def _get_locks(action_module, request):
+    """Names of the resources a request needs exclusive access to.
+
+    Action modules can define a ``get_locks(request)`` hook. By default, the
+    feedstocks listed in the request are locked.
+    """
+    if hasattr(action_module, "get_locks"):
+        return frozenset(action_module.get_locks(request))
+    feedstocks = request.get("feedstocks") or ()
+    if not isinstance(feedstocks, (list, dict)):
+        return frozenset()
+    return frozenset(str(feedstock) for feedstock in feedstocks)
+
+
+def _is_retry(filename):
+    """Whether the request file was kept by a previous run after failing."""
+    subject = subprocess.check_output(
+        ["git", "log", "-1", "--format=%s", "--", filename], text=True
+    )
+    return subject.startswith("Keeping ")
+
+
+def _check_task_file(filename):
+    with open(filename) as f:
+        request = yaml.safe_load(f)
+
+    assert "action" in request, f"Invalid request: {request}"
+
+    action = request["action"]
+    actions = get_actions()
+
+    if action not in actions:
+        assert False, f"Unknown action: {action}"
+
+    getattr(actions[action], "check")(request)
+
+
+def _run_task(action_module, task):
+    if not task.retry:
+        return getattr(action_module, "run")(task.request)
+    # retries must not eat into the GitHub API budget needed for new requests
+    with github_low_priority():
+        return getattr(action_module, "run")(task.request)
+
+
+def check(jobs=1):
     # error if people put thinks in old places
     old_files = glob.glob("broken/*")
     if old_files:
@@ -44,25 +124,196 @@ def check():
 
     filenames = _get_task_files()
 
-    for filename in filenames:
-        with open(filename) as f:
-            request = yaml.safe_load(f)
+    # validate all files, even if some of them fail, and report all errors at once
+    errors = []
+    deferred = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_check_task_file, filename) for filename in filenames
+        ]
+        for filename, future in zip(filenames, futures):
+            try:
+                future.result()
+            except RateLimitDeferred as e:
+                e.add_note(f"while checking {filename}")
+                deferred.append((filename, e))
+            except Exception as e:
+                e.add_note(f"while checking {filename}")
+                errors.append((filename, e))
 
-        assert "action" in request, f"Invalid request: {request}"
+    if deferred:
+        print(
+            "\nThe following requests could not be checked because of the GitHub "
+            "API rate limit, please re-run the check later:",
+            file=sys.stderr,
+        )
+        for filename, e in deferred:
+            print(f"::warning::{filename}: {e}", file=sys.stderr, flush=True)
+    if errors:
+        print("\nThe following requests are invalid:", file=sys.stderr)
+        for filename, e in errors:
+            print(f"::error::{filename}: {e!r}", file=sys.stderr, flush=True)
+        raise ExceptionGroup(
+            f"{len(errors)} of {len(filenames)} request(s) are invalid",
+            [e for _, e in errors + deferred],
+        )
+    if deferred:
+        raise ExceptionGroup(
+            f"{len(deferred)} of {len(filenames)} request(s) could not be checked "
+            "yet because of the GitHub API rate limit",
+            [e for _, e in deferred],
+        )
 
-        action = request["action"]
-        actions = get_actions()
 
-        if action not in actions:
-            assert False, f"Unknown action: {action}"
+def _execute_tasks(tasks, jobs, action_limits):
+    """Run the tasks on a pool of ``jobs`` threads.
+
+    A task is only started once no running or earlier pending task holds any of
+    its locks, so requests touching the same resources are processed one after
+    another, in order. Tasks holding `EXCLUSIVE_LOCK` run alone. Returns two
+    dicts mapping filenames to the value returned by the action's ``run`` and to
+    the raised exception, respectively.
+    """
+    actions = get_actions()
+    results = {}
+    errors = {}
+    pending = list(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            claimed = set().union(*(task.locks for task in running.values()))
+            counts = Counter(task.action for task in running.values())
+            for task in list(pending):
+                if len(running) >= jobs:
+                    break
+                limit = action_limits.get(task.action)
+                exclusive = EXCLUSIVE_LOCK in task.locks and (running or claimed)
+                if (
+                    task.locks & claimed
+                    or EXCLUSIVE_LOCK in claimed
+                    or exclusive
+                    or (limit is not None and counts[task.action] >= limit)
+                ):
+                    # later requests on the same resources have to wait too
+                    claimed |= task.locks
+                    continue
+                pending.remove(task)
+                claimed |= task.locks
+                counts[task.action] += 1
+                print(f"Processing {task.filename} ({task.action})", flush=True)
+                future = executor.submit(_run_task, actions[task.action], task)
+                running[future] = task
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    results[task.filename] = future.result()
+                except RateLimitDeferred as e:
+                    # leave the request untouched for the next run
+                    print(f"Deferring {task.filename}: {e}", flush=True)
+                except Exception as e:
+                    print(
+                        f"::error::Processing {task.filename} failed:",
+                        "".join(traceback.format_exception(e)),
+                        file=sys.stderr,
+                        flush=True,
+                    )
+                    e.add_note(f"while processing {task.filename}")
+                    errors[task.filename] = e
+    return results, errors
+
+
+def _finalize_actions(tasks, results):
+    """Call the ``finalize(results)`` hook of every action module that defines one.
+
+    Actions use it to apply work collected from all requests of a run at once.
+    The hook gets the results of the module's requests, as a dict mapping
+    filenames to the values returned by ``run``, and returns them updated with
+    the outcome of that work. If it raises, ``results`` are left untouched, so
+    the requests must return what is needed to try again from ``run``. Returns
+    a dict mapping module names to the exceptions raised by the hooks.
+    """
+    actions = get_actions()
+    errors = {}
+    for action_module in dict.fromkeys(actions.values()):
+        if not hasattr(action_module, "finalize"):
+            continue
+        module_results = {
+            task.filename: results[task.filename]
+            for task in tasks
+            if actions[task.action] is action_module and task.filename in results
+        }
+        try:
+            results.update(action_module.finalize(module_results))
+        except Exception as e:
+            print(
+                f"::error::Finalizing {action_module.__name__} failed:",
+                "".join(traceback.format_exception(e)),
+                file=sys.stderr,
+                flush=True,
+            )
+            errors[action_module.__name__] = e
+    return errors
+
+
+def _update_task_file(filename, action, try_again):
+    """Record the outcome of a request in git.
 
-        getattr(actions[action], "check")(request)
+    Returns True if the request has been failing for long enough that an issue
+    should be raised for it.
+    """
+    if not try_again:
+        subprocess.check_call(["git", "rm", filename])
+        subprocess.check_call(
+            ["git", "commit", "-m", f"Remove {filename} after {action}"]
+        )
+        return False
+
+    with open(filename, "w") as fp:
+        yaml.dump(try_again, fp)
+    subprocess.check_call(["git", "add", filename])
+    if subprocess.call(["git", "diff", "--cached", "--quiet"]) != 0:
+        # Only commit if there are changes
+        subprocess.check_call(
+            [
+                "git",
+                "commit",
+                "-m",
+                f"Keeping {filename} after failed {action}",
+            ]
+        )
+        return False
+
+    # How old is this failing file? Raise issue after 6h of last modification
+    added_at = subprocess.check_output(
+        [
+            "git",
+            "log",
+            "-1",
+            "--format=%aI",
+            "--",
+            filename,
+        ],
+        text=True,
+    ).strip()
+    if not added_at:
+        print(
+            "::error::No timestamp information for",
+            filename,
+            file=sys.stderr,
+        )
+        return False
+    added_at_dt = datetime.fromisoformat(added_at)
+    # Keep this magic number in sync with the issue message in GHA's main.yml
+    return datetime.now(tz=timezone.utc) - added_at_dt > timedelta(hours=6)
 
 
-def run():
+def run(jobs=DEFAULT_JOBS, action_limits=None):
+    action_limits = {**DEFAULT_ACTION_LIMITS, **(action_limits or {})}
     filenames = _get_task_files()
 
-    failing_filenames_to_raise = []
+    tasks = []
     for filename in filenames:
         with open(filename) as f:
             request = yaml.safe_load(f)
@@ -75,66 +326,84 @@ def run():
         if action not in actions:
             assert False, f"Unknown action: {action}"
 
-        try_again = getattr(actions[action], "run")(request)
-
-        if try_again:
-            with open(filename, "w") as fp:
-                yaml.dump(try_again, fp)
-            subprocess.check_call(["git", "add", filename])
-            if subprocess.call(["git", "diff", "--cached", "--quiet"]) != 0:
-                # Only commit if there are changes
-                subprocess.check_call(
-                    [
-                        "git",
-                        "commit",
-                        "-m",
-                        f"Keeping {filename} after failed {action}",
-                    ]
-                )
-            else:
-                # How old is this failing file? Raise issue after 6h of last modification
-                added_at = subprocess.check_output(
-                    [
-                        "git",
-                        "log",
-                        "-1",
-                        "--format=%aI",
-                        "--",
-                        filename,
-                    ],
-                    text=True,
-                ).strip()
-                if added_at:
-                    added_at_dt = datetime.fromisoformat(added_at)
-                    # Keep this magic number in sync with the issue message in GHA's main.yml
-                    if datetime.now(tz=timezone.utc) - added_at_dt > timedelta(hours=6):
-                        failing_filenames_to_raise.append(filename)
-                else:
-                    print(
-                        "::error::No timestamp information for",
-                        filename,
-                        file=sys.stderr,
-                    )
-        else:
-            subprocess.check_call(["git", "rm", filename])
-            subprocess.check_call(
-                ["git", "commit", "-m", f"Remove {filename} after {action}"]
+        tasks.append(
+            _Task(
+                filename,
+                action,
+                request,
+                _get_locks(actions[action], request),
+                _is_retry(filename),
             )
+        )
+
+    results, errors = _execute_tasks(tasks, jobs, action_limits)
+    errors.update(_finalize_actions(tasks, results))
+
+    # git bookkeeping happens sequentially, in the original order of the files
+    failing_filenames_to_raise = []
+    for task in tasks:
+        if task.filename not in results:
+            continue
+        if _update_task_file(task.filename, task.action, results[task.filename]):
+            failing_filenames_to_raise.append(task.filename)
+
     if failing_filenames_to_raise:
         with open(os.environ["GITHUB_ENV"], "a") as f:
             f.write(
                 f"FAILING_FILENAMES_TO_RAISE={' '.join(failing_filenames_to_raise)}\n"
             )
 
+    if errors:
+        raise ExceptionGroup(
+            f"{len(errors)} request(s) could not be processed", list(errors.values())
+        )
+
+
+def _positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return value
+
+
+def _action_limit(value):
+    action, sep, limit = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected ACTION=N, got {value!r}")
+    return action, _positive_int(limit)
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m conda_forge_admin_requests")
+    parser.add_argument("command", choices=["check", "run"])
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_positive_int,
+        default=None,
+        help=(
+            "number of requests processed concurrently "
+            f"(default: {DEFAULT_JOBS} for `run`, 1 for `check`)"
+        ),
+    )
+    parser.add_argument(
+        "--action-limit",
+        type=_action_limit,
+        action="append",
+        default=[],
+        metavar="ACTION=N",
+        help="maximum number of concurrent `run` requests for ACTION (repeatable)",
+    )
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python -m conda_forge_admin_requests [check | run]")
+    args = _parse_args()
 
     register_actions()
-    check_only = sys.argv[1] == "check"
+    check_only = args.command == "check"
 
     if check_only:
-        check()
+        check(jobs=args.jobs or 1)
     else:
-        run()
+        run(jobs=args.jobs or DEFAULT_JOBS, action_limits=dict(args.action_limit))
@@ -1,17 +1,229 @@
 from __future__ import annotations
 
 import copy
+import fnmatch
+import re
+from datetime import datetime, timedelta, timezone
+
+from .utils import (
+    GH_ORG,
+    get_gh_headers,
+    get_session,
+    map_concurrently,
+    raise_json_for_status,
+    run_graphql,
+)
+
+# number of refs fetched per page and per kind (branches or tags)
+REFS_PAGE_SIZE = 100
+
+_REFS_QUERY = """
+query(
+  $owner: String!, $name: String!, $first: Int!,
+  $withHeads: Boolean!, $headsAfter: String,
+  $withTags: Boolean!, $tagsAfter: String
+) {
+  repository(owner: $owner, name: $name) {
+    id
+    defaultBranchRef { name }
+    heads: refs(refPrefix: "refs/heads/", first: $first, after: $headsAfter)
+        @include(if: $withHeads) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name target { oid ... on Commit { committedDate } } }
+    }
+    tags: refs(refPrefix: "refs/tags/", first: $first, after: $tagsAfter)
+        @include(if: $withTags) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name target { oid ... on Tag { target { oid } } } }
+    }
+  }
+}
+"""
+
+
+def _get_refs(repo: str) -> dict[str, dict[str, dict]] | None:
+    """Fetch all branches and tags of ``GH_ORG/repo`` with paginated GraphQL queries.
+
+    Returns None if the repository does not exist, or else a dict with the
+    repository's node ``id``, its ``default_branch`` and the keys ``heads`` and
+    ``tags``. They map ref names to dicts holding the SHA of the ref's target
+    (``oid``) and, respectively, the date of the commit (``committed_date``) or
+    the SHA of the tagged object (``commit``).
+    """
+    refs = {"heads": {}, "tags": {}}
+    variables = {
+        "owner": GH_ORG,
+        "name": repo,
+        "first": REFS_PAGE_SIZE,
+        "withHeads": True,
+        "headsAfter": None,
+        "withTags": True,
+        "tagsAfter": None,
+    }
+    while variables["withHeads"] or variables["withTags"]:
+        repository = run_graphql(_REFS_QUERY, variables)["repository"]
+        if repository is None:
+            return None
+        refs["id"] = repository["id"]
+        refs["default_branch"] = (repository["defaultBranchRef"] or {}).get("name")
+        for node in (repository.get("heads") or {}).get("nodes", []):
+            refs["heads"][node["name"]] = {
+                "oid": node["target"]["oid"],
+                "committed_date": node["target"].get("committedDate"),
+            }
+        for node in (repository.get("tags") or {}).get("nodes", []):
+            # lightweight tags point to the commit directly
+            refs["tags"][node["name"]] = {
+                "oid": node["target"]["oid"],
+                "commit": (node["target"].get("target") or node["target"])["oid"],
+            }
+        for kind in ("heads", "tags"):
+            with_kind = f"with{kind.title()}"
+            if variables[with_kind]:
+                page_info = repository[kind]["pageInfo"]
+                variables[with_kind] = page_info["hasNextPage"]
+                variables[f"{kind}After"] = page_info["endCursor"]
+    return refs
+
+
+# units of the `older_than` ages of branch patterns, in days
+AGE_UNITS = {"d": 1, "w": 7, "m": 30, "y": 365}
+
+
+def _parse_age(age: str) -> timedelta:
+    match = re.fullmatch(r"(\d+)([dwmy])", str(age))
+    if match is None:
+        raise ValueError(
+            f"'older_than' must be a number followed by one of "
+            f"{', '.join(AGE_UNITS)} (e.g. 2y), got {age!r}"
+        )
+    return timedelta(days=int(match.group(1)) * AGE_UNITS[match.group(2)])
 
-import requests
 
-from .utils import GH_ORG, get_gh_headers, raise_json_for_status
+def _check_pattern(feedstock, spec):
+    if not isinstance(spec.get("pattern"), str) or set(spec) - {
+        "pattern",
+        "older_than",
+    }:
+        raise ValueError(
+            f"branches for '{feedstock}' must be a list or a mapping with the keys "
+            f"'pattern' and optionally 'older_than', got {spec!r}"
+        )
+    if "older_than" in spec:
+        _parse_age(spec["older_than"])
+
+
+def _expand_pattern(spec, refs):
+    """Return the branches matching a ``{pattern, older_than}`` spec, whose last
+    commit is older than ``older_than`` if given. The default branch, and heads
+    that do not point to a commit, are never selected."""
+    cutoff = None
+    if "older_than" in spec:
+        cutoff = datetime.now(tz=timezone.utc) - _parse_age(spec["older_than"])
+    return sorted(
+        branch
+        for branch, head in refs["heads"].items()
+        if branch not in ("main", refs["default_branch"])
+        and fnmatch.fnmatchcase(branch, spec["pattern"])
+        and (
+            cutoff is None
+            or head["committed_date"] is not None
+            and datetime.fromisoformat(head["committed_date"]) < cutoff
+        )
+    )
 
 
-def check(request):
+def _get_tag_target(repo, sha):
+    r = get_session().get(
+        f"https://api.github.com/repos/{GH_ORG}/{repo}/git/tags/{sha}",
+        headers=get_gh_headers(),
+    )
+    raise_json_for_status(r)
+    return r.json()["object"]["sha"]
+
+
+def _check_journal(task, feedstock, branch, entry, refs):
+    """Check that a journaled branch is in a state a previous run left it in.
+
+    The refs must be at the journaled ``commit`` and ``tag``, either before or
+    after the update, so that a request cannot bypass the checks of `check` by
+    bringing its own journal.
+    """
+    if not isinstance(entry, dict) or set(entry) != {"commit", "tag"}:
+        return [f"{feedstock}: invalid journal entry for '{branch}': {entry!r}"]
+    head = refs["heads"].get(branch)
+    tag = refs["tags"].get(branch)
+    if (
+        (head is None and tag is None)
+        or (head is not None and head["oid"] != entry["commit"])
+        or (
+            tag is not None
+            and (tag["oid"], tag["commit"]) != (entry["tag"], entry["commit"])
+        )
+    ):
+        return [
+            f"{feedstock}: branch and tag '{branch}' do not match the journal "
+            f"entry {entry!r}"
+        ]
+    if (
+        task == "archive_branch"
+        and tag is None
+        and _get_tag_target(f"{feedstock}-feedstock", entry["tag"]) != entry["commit"]
+    ):
+        return [
+            f"{feedstock}: tag object {entry['tag']} does not point to "
+            f"{entry['commit']}"
+        ]
+    return []
+
+
+def _check_branches(task, feedstock, branches, journal):
+    """Return the errors, the expanded branches and the refs of a feedstock."""
+    refs = _get_refs(f"{feedstock}-feedstock")
+    if refs is None:
+        return [f"Cannot find {GH_ORG}/{feedstock}-feedstock!"], branches, refs
+
+    if isinstance(branches, dict):
+        spec, branches = branches, _expand_pattern(branches, refs)
+        if not branches:
+            return [f"{feedstock}: no branch matches {spec!r}"], branches, refs
+        print(f"{feedstock}: {spec!r} matches branches {branches!r}", flush=True)
+
+    errors = [
+        f"{feedstock}: journal entry for '{branch}', which is not requested"
+        for branch in journal
+        if branch not in branches
+    ]
+    for branch in branches:
+        if branch in journal:
+            # partially processed by a previous run, `run` resumes it
+            errors.extend(
+                _check_journal(task, feedstock, branch, journal[branch], refs)
+            )
+            continue
+        if task == "archive_branch":
+            # branch must exist, tag must NOT exist
+            if branch not in refs["heads"]:
+                errors.append(f"{feedstock}: branch '{branch}' not found")
+            if branch in refs["tags"]:
+                errors.append(f"{feedstock}: tag '{branch}' already exists")
+        elif task == "unarchive_branch":
+            # tag must exist, branch must NOT exist
+            if branch not in refs["tags"]:
+                errors.append(f"{feedstock}: tag '{branch}' not found")
+            if branch in refs["heads"]:
+                errors.append(f"{feedstock}: branch '{branch}' already exists")
+    return errors, branches, refs
+
+
+def _check_request(request):
+    """Validate a request and return its feedstocks mapped to their expanded
+    branches and their refs."""
     assert "feedstocks" in request
     assert "action" in request
     feedstocks = request["feedstocks"]
     task = request["action"]
+    journal = request.get("journal") or {}
 
     if not isinstance(feedstocks, dict):
         raise ValueError(
@@ -19,159 +231,201 @@ def check(request):
         )
     if task not in ("archive_branch", "unarchive_branch"):
         raise ValueError(f"Illegal value for action: {task}")
+    if not isinstance(journal, dict) or not all(
+        isinstance(entries, dict) for entries in journal.values()
+    ):
+        raise ValueError("'journal' must be a mapping from feedstock names to dicts")
+    if set(journal) - set(feedstocks):
+        raise ValueError(
+            f"'journal' has entries for feedstocks that are not requested: "
+            f"{sorted(set(journal) - set(feedstocks))!r}"
+        )
 
     print(f"received map from feedstocks to branches-to-be-archived: {feedstocks!r}")
-    owner = GH_ORG
-    headers = get_gh_headers()
 
     for feedstock, branches in feedstocks.items():
-        repo = f"{feedstock}-feedstock"
-        api_base_url = f"https://api.github.com/repos/{owner}/{repo}"
-
-        r = requests.get(api_base_url, headers=headers)
-        if r.status_code != 200:
-            raise ValueError(f"Cannot find {owner}/{repo}!")
-
+        if isinstance(branches, dict) and task == "archive_branch":
+            _check_pattern(feedstock, branches)
+            continue
         if not isinstance(branches, list):
             raise ValueError(
                 f"branches for '{feedstock}' must be a list, got {branches!r}"
             )
-
         for branch in branches:
             if branch == "main":
                 raise ValueError(
                     f"{feedstock}: Task '{task}' is not allwed for 'main' branch"
                 )
 
-            if task == "archive_branch":
-                # branch must exist
-                r = requests.get(f"{api_base_url}/branches/{branch}", headers=headers)
-                if r.status_code != 200:
-                    raise ValueError(f"{feedstock}: branch '{branch}' not found")
-
-                # tag must NOT exist
-                r = requests.get(
-                    f"{api_base_url}/git/ref/tags/{branch}", headers=headers
-                )
-                if r.status_code == 200:
-                    raise ValueError(f"{feedstock}: tag '{branch}' already exists")
+    # all branches of all feedstocks are validated, and all errors reported
+    errors = []
+    checked = {}
+    for (feedstock, _), result, exc in map_concurrently(
+        lambda item: _check_branches(task, *item, journal.get(item[0], {})),
+        feedstocks.items(),
+    ):
+        if exc is not None:
+            errors.append(f"{feedstock}: could not list branches and tags: {exc!r}")
+        else:
+            feedstock_errors, branches, refs = result
+            errors.extend(feedstock_errors)
+            checked[feedstock] = (branches, refs)
+    if errors:
+        raise ValueError("\n".join(errors))
+    return checked
 
-            elif task == "unarchive_branch":
-                # tag must exist
-                r = requests.get(
-                    f"{api_base_url}/git/ref/tags/{branch}", headers=headers
-                )
-                if r.status_code != 200:
-                    raise ValueError(f"{feedstock}: tag '{branch}' not found")
 
-                # branch must NOT exist
-                r = requests.get(f"{api_base_url}/branches/{branch}", headers=headers)
-                if r.status_code == 200:
-                    raise ValueError(f"{feedstock}: branch '{branch}' already exists")
+def check(request):
+    _check_request(request)
 
 
-def _archive_branch(owner, repo, branch, headers):
-    api_base_url = f"https://api.github.com/repos/{owner}/{repo}"
+ZERO_OID = "0" * 40
 
-    # get SHA and date of last commit on branch
-    r = requests.get(f"{api_base_url}/branches/{branch}", headers=headers)
-    raise_json_for_status(r)
-    branch_data = r.json()
-    commit_sha = branch_data["commit"]["sha"]
-    commit_date = branch_data["commit"]["commit"]["committer"]["date"]
-
-    # create annotated tag object with the commit's timestamp
-    r = requests.post(
-        f"{api_base_url}/git/tags",
-        headers=headers,
+# updateRefs and RefUpdate are part of the "Update refs" schema preview
+UPDATE_REFS_PREVIEWS = ("update-refs",)
+
+_UPDATE_REFS_MUTATION = """
+mutation($repositoryId: ID!, $refUpdates: [RefUpdate!]!) {
+  updateRefs(input: {repositoryId: $repositoryId, refUpdates: $refUpdates}) {
+    clientMutationId
+  }
+}
+"""
+
+
+def _create_tag_object(repo, branch, head):
+    # annotated tag object with the timestamp of the branch's last commit
+    r = get_session().post(
+        f"https://api.github.com/repos/{GH_ORG}/{repo}/git/tags",
+        headers=get_gh_headers(),
         json={
             "tag": branch,
             "message": f"Archived branch {branch}",
-            "object": commit_sha,
+            "object": head["oid"],
             "type": "commit",
             "tagger": {
                 "name": "conda-forge-admin",
                 "email": "conda-forge-admin@conda-forge.org",
-                "date": commit_date,
+                "date": head["committed_date"],
             },
         },
     )
     raise_json_for_status(r)
-    tag_sha = r.json()["sha"]
-
-    # create ref pointing to the annotated tag object
-    r = requests.post(
-        f"{api_base_url}/git/refs",
-        headers=headers,
-        json={"ref": f"refs/tags/{branch}", "sha": tag_sha},
-    )
-    raise_json_for_status(r)
-
-    # delete branch
-    r = requests.delete(f"{api_base_url}/git/refs/heads/{branch}", headers=headers)
-    raise_json_for_status(r)
+    return r.json()["sha"]
 
-    print(f"{repo}: archived branch '{branch}' as tag '{branch}'", flush=True)
 
+def _plan_ref_update(repo, name, current, expected, target):
+    """Return the update moving ref ``name`` from ``expected`` to ``target``.
 
-def _unarchive_branch(owner, repo, branch, headers):
-    api_base_url = f"https://api.github.com/repos/{owner}/{repo}"
-
-    # get SHA of annotated tag, then dereference to the underlying commit
-    r = requests.get(f"{api_base_url}/git/ref/tags/{branch}", headers=headers)
-    raise_json_for_status(r)
-    tag_sha = r.json()["object"]["sha"]
-    r = requests.get(f"{api_base_url}/git/tags/{tag_sha}", headers=headers)
-    raise_json_for_status(r)
-    commit_sha = r.json()["object"]["sha"]
-
-    # create branch
-    r = requests.post(
-        f"{api_base_url}/git/refs",
-        headers=headers,
-        json={"ref": f"refs/heads/{branch}", "sha": commit_sha},
-    )
-    raise_json_for_status(r)
-
-    # delete tag
-    r = requests.delete(f"{api_base_url}/git/refs/tags/{branch}", headers=headers)
-    raise_json_for_status(r)
-
-    print(f"{repo}: restored branch '{branch}' from tag '{branch}'", flush=True)
+    Returns None if the ref is already at ``target``, and raises if it is
+    neither there nor at ``expected``.
+    """
+    current = current or ZERO_OID
+    if current == target:
+        return None
+    if current != expected:
+        raise RuntimeError(
+            f"{repo}: {name} is at {current}, expected {expected} or {target}"
+        )
+    return {"name": name, "beforeOid": expected, "afterOid": target}
+
+
+def _process_feedstock(task, feedstock, branches, refs, journal):
+    """Archive or unarchive the branches of a feedstock in one batch of ref updates.
+
+    ``refs`` are the refs listed by `_check_request`; updates are only applied
+    if the refs did not move since. ``journal`` maps branches to the ``commit``
+    and the ``tag`` object SHAs they are archived as, or restored from. It is
+    updated in place before any ref is changed, so that a retry can finish the
+    work instead of starting over.
+    """
+    repo = f"{feedstock}-feedstock"
+    ref_updates = []
+    for branch in branches:
+        head = refs["heads"].get(branch)
+        tag = refs["tags"].get(branch)
+        if branch not in journal:
+            if task == "archive_branch":
+                journal[branch] = {
+                    "commit": head["oid"],
+                    "tag": _create_tag_object(repo, branch, head),
+                }
+            else:
+                journal[branch] = {"commit": tag["commit"], "tag": tag["oid"]}
+        commit_sha = journal[branch]["commit"]
+        tag_sha = journal[branch]["tag"]
+
+        if task == "archive_branch":
+            # create tag ref pointing to the annotated tag object, delete branch
+            updates = [
+                (f"refs/tags/{branch}", tag, ZERO_OID, tag_sha),
+                (f"refs/heads/{branch}", head, commit_sha, ZERO_OID),
+            ]
+        else:
+            # create branch at the tagged commit, delete tag
+            updates = [
+                (f"refs/heads/{branch}", head, ZERO_OID, commit_sha),
+                (f"refs/tags/{branch}", tag, tag_sha, ZERO_OID),
+            ]
+        for name, current, expected, target in updates:
+            ref_update = _plan_ref_update(
+                repo, name, current and current["oid"], expected, target
+            )
+            if ref_update is not None:
+                ref_updates.append(ref_update)
+
+    if ref_updates:
+        # all updates are applied atomically, and only if the refs did not move
+        run_graphql(
+            _UPDATE_REFS_MUTATION,
+            {"repositoryId": refs["id"], "refUpdates": ref_updates},
+            previews=UPDATE_REFS_PREVIEWS,
+        )
+    for branch in branches:
+        if task == "archive_branch":
+            print(f"{repo}: archived branch '{branch}' as tag '{branch}'", flush=True)
+        else:
+            print(f"{repo}: restored branch '{branch}' from tag '{branch}'", flush=True)
 
 
 def run(request: dict[str, object]) -> dict[str, object] | None:
-    check(request)
+    # branch patterns are expanded once, so that retries work on the same set
+    checked = _check_request(request)
 
     task = request["action"]
-    owner = GH_ORG
-    headers = get_gh_headers()
-
     failed_feedstocks = {}
-
-    for feedstock, branches in request["feedstocks"].items():
-        repo = f"{feedstock}-feedstock"
-        failed_branches = []
-
-        for branch in branches:
-            try:
-                if task == "archive_branch":
-                    _archive_branch(owner, repo, branch, headers)
-                else:
-                    _unarchive_branch(owner, repo, branch, headers)
-            except Exception as e:
-                print(
-                    f"failed to {task} branch '{branch}' on '{feedstock}': {e!r}",
-                    flush=True,
-                )
-                failed_branches.append(branch)
-
-        if failed_branches:
-            failed_feedstocks[feedstock] = failed_branches
+    feedstocks = {
+        feedstock: branches for feedstock, (branches, _) in checked.items() if branches
+    }
+
+    journal = copy.deepcopy(request.get("journal") or {})
+    for feedstock in feedstocks:
+        journal.setdefault(feedstock, {})
+
+    # feedstocks are processed concurrently, with one batch of ref updates each
+    for (feedstock, branches), _, exc in map_concurrently(
+        lambda item: _process_feedstock(
+            task, *item, checked[item[0]][1], journal[item[0]]
+        ),
+        feedstocks.items(),
+    ):
+        if exc is not None:
+            print(
+                f"failed to {task} branches {branches!r} on '{feedstock}': {exc!r}",
+                flush=True,
+            )
+            failed_feedstocks[feedstock] = branches
 
     if failed_feedstocks:
         request = copy.deepcopy(request)
         request["feedstocks"] = failed_feedstocks
+        request["journal"] = {
+            feedstock: journal[feedstock]
+            for feedstock in failed_feedstocks
+            if journal.get(feedstock)
+        }
+        if not request["journal"]:
+            del request["journal"]
         return request
     else:
         return None
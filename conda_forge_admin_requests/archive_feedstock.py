@@ -2,56 +2,108 @@ from __future__ import annotations
 
 import copy
 
-import requests
-
-from .utils import GH_ORG, get_gh_headers, raise_json_for_status
-
-
-def process_repo(repo, task):
-    owner = GH_ORG
-    headers = get_gh_headers()
-
-    r = requests.get(
-        f"https://api.github.com/repos/{owner}/{repo}",
-        headers=headers,
+from .utils import (
+    get_feedstock_repos,
+    map_concurrently,
+    run_graphql_aliases,
+)
+
+# number of repositories (un)archived per GraphQL mutation, and of mutations
+# sent at the same time
+ARCHIVE_BATCH_SIZE = 20
+MAX_ARCHIVE_WORKERS = 4
+
+
+def _set_archived(repos: dict[str, str], task: str) -> dict[str, Exception | None]:
+    """Archive or unarchive repositories with one aliased GraphQL mutation.
+
+    ``repos`` maps feedstocks to the node IDs of their repositories. Returns a
+    dict mapping each feedstock to the exception that occurred, or None.
+    """
+    mutation = "archiveRepository" if task == "archive" else "unarchiveRepository"
+    feedstocks = list(repos)
+    params = ", ".join(f"$id{i}: ID!" for i in range(len(feedstocks)))
+    fields = "\n".join(
+        f"m{i}: {mutation}(input: {{repositoryId: $id{i}}}) "
+        "{ repository { isArchived } }"
+        for i in range(len(feedstocks))
+    )
+    data, errors = run_graphql_aliases(
+        f"mutation({params}) {{\n{fields}\n}}",
+        {f"id{i}": repos[feedstock] for i, feedstock in enumerate(feedstocks)},
     )
-    raise_json_for_status(r)
 
+    results = {}
+    for i, feedstock in enumerate(feedstocks):
+        result = data.get(f"m{i}")
+        if f"m{i}" in errors:
+            results[feedstock] = RuntimeError(errors[f"m{i}"])
+        elif result is None or result["repository"]["isArchived"] != (
+            task == "archive"
+        ):
+            results[feedstock] = RuntimeError(f"unexpected result {result!r}")
+        else:
+            results[feedstock] = None
+    return results
+
+
+def process_repos(feedstocks, task, repos=None) -> dict[str, Exception | None]:
+    """Archive or unarchive feedstocks in batches.
+
+    ``repos`` are the feedstocks' repositories as returned by
+    `get_feedstock_repos`, which are looked up if not given. Returns a dict
+    mapping each feedstock to the exception that occurred, or None.
+    """
+    if repos is None:
+        repos = get_feedstock_repos(feedstocks)
     if task == "archive":
         target_status = "archived"
     else:
         target_status = "unarchived"
 
-    data = r.json()
-    if task == "archive" and data["archived"]:
-        print(f"feedstock {repo} is already {target_status}", flush=True)
-        return
-
-    if task == "unarchive" and not data["archived"]:
-        print(f"feedstock {repo} is already {target_status}", flush=True)
-        return
-
-    r = requests.patch(
-        f"https://api.github.com/repos/{owner}/{repo}",
-        headers=headers,
-        json={"archived": task == "archive"},
-    )
-    raise_json_for_status(r)
-
-    print(f"feedstock {repo} was {target_status}", flush=True)
+    results = {}
+    to_change = {}
+    for feedstock, repo in repos.items():
+        if repo is None:
+            results[feedstock] = ValueError(f"{feedstock}-feedstock does not exist")
+        elif repo["archived"] == (task == "archive"):
+            print(
+                f"feedstock {feedstock}-feedstock is already {target_status}",
+                flush=True,
+            )
+            results[feedstock] = None
+        else:
+            to_change[feedstock] = repo["id"]
+
+    batches = [
+        dict(list(to_change.items())[start : start + ARCHIVE_BATCH_SIZE])
+        for start in range(0, len(to_change), ARCHIVE_BATCH_SIZE)
+    ]
+    for batch, batch_results, exc in map_concurrently(
+        lambda batch: _set_archived(batch, task),
+        batches,
+        max_workers=MAX_ARCHIVE_WORKERS,
+    ):
+        if exc is not None:
+            batch_results = dict.fromkeys(batch, exc)
+        for feedstock, feedstock_exc in batch_results.items():
+            if feedstock_exc is None:
+                print(
+                    f"feedstock {feedstock}-feedstock was {target_status}", flush=True
+                )
+            results[feedstock] = feedstock_exc
+    return results
 
 
 def run(request: dict[str, object]) -> dict[str, object] | None:
-    check(request)
+    repos = _check_request(request)
     feedstocks = request["feedstocks"]
     task = request["action"]
 
     pkgs_to_do_again = []
-    for feedstock in feedstocks:
-        try:
-            process_repo(f"{feedstock}-feedstock", task)
-        except Exception as e:
-            print(f"failed to {task} '{feedstock}': {e!r}", flush=True)
+    for feedstock, exc in process_repos(feedstocks, task, repos).items():
+        if exc is not None:
+            print(f"failed to {task} '{feedstock}': {exc!r}", flush=True)
             pkgs_to_do_again.append(feedstock)
 
     if pkgs_to_do_again:
@@ -62,17 +114,21 @@ def run(request: dict[str, object]) -> dict[str, object] | None:
         return None
 
 
-def check(request):
+def _check_request(request):
+    """Validate a request and return the repositories of its feedstocks."""
     assert "feedstocks" in request
 
-    missing_feedstocks = []
-
-    for feedstock in request["feedstocks"]:
-        r = requests.get(f"https://github.com/conda-forge/{feedstock}-feedstock")
-        if r.status_code != 200:
-            missing_feedstocks.append(feedstock)
+    repos = get_feedstock_repos(request["feedstocks"])
+    missing_feedstocks = [
+        feedstock for feedstock, repo in repos.items() if repo is None
+    ]
 
     if missing_feedstocks:
         raise RuntimeError(
             f"{list(set(missing_feedstocks))} feedstocks could not be found!"
         )
+    return repos
+
+
+def check(request):
+    _check_request(request)
@@ -5,16 +5,74 @@ Copy approved artifacts from an external channel to production conda-forge.
 from __future__ import annotations
 
 import copy
+import functools
+import hashlib
 import hmac
 import os
-import subprocess
+
+from binstar_client import Binstar
 
 import requests
 
-from .utils import parse_filename, split_label_from_channel
+from .utils import (
+    DEFAULT_MAX_WORKERS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_RETRY,
+    ExpiringStore,
+    get_session,
+    map_concurrently,
+    parse_filename,
+    split_label_from_channel,
+)
+
+# Successful verifications are remembered for this long (in seconds), so that
+# `run` and its retries do not repeat them. Keep it short, since an artifact can
+# be replaced on its source channel.
+VERIFICATION_TTL = 2 * 3600
+
+# number of artifacts copied at the same time
+MAX_COPY_WORKERS = 8
+
+# With `deep_verify`, artifacts are downloaded and hashed in chunks of this size,
+# several of them at a time.
+DEEP_VERIFY_CHUNK_SIZE = 1024**2
+MAX_DEEP_VERIFY_WORKERS = 4
+
+
+@functools.cache
+def _get_verified_artifacts():
+    return ExpiringStore("cfep3_verified_artifacts", VERIFICATION_TTL)
+
+
+def _hash_artifact(url: str) -> str:
+    """Compute the SHA256 of the file at ``url`` without keeping it around."""
+    digest = hashlib.sha256()
+    with get_session().get(url, stream=True) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=DEEP_VERIFY_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def check_one(package: str, sha256: str):
+def _get_dist_sha256(package: str, revalidate: bool = False) -> str:
+    """Return the SHA256 of an artifact according to the anaconda.org API.
+
+    With ``revalidate``, a response cached by the session is not used without
+    checking with the server first.
+    """
+    channel_and_maybe_label, subdir, artifact = package.rsplit("/", 2)
+    channel, _ = split_label_from_channel(channel_and_maybe_label)
+    pkg_name, version, _, _ = parse_filename(artifact)
+    r = get_session().get(
+        f"https://api.anaconda.org/dist/{channel}/{pkg_name}/{version}/{subdir}/{artifact}",
+        headers={"Cache-Control": "no-cache"} if revalidate else None,
+        timeout=10,
+    )
+    r.raise_for_status()
+    return r.json()["sha256"]
+
+
+def check_one(package: str, sha256: str, deep_verify: bool = False):
     if not isinstance(sha256, str) or len(sha256) != 64:
         raise ValueError(
             f"Key '{sha256}' must be SHA256 for the artifact (64 hexadecimal characters)"
@@ -22,28 +80,76 @@ def check_one(package: str, sha256: str):
 
     channel_and_maybe_label, subdir, artifact = package.rsplit("/", 2)
     channel, _ = split_label_from_channel(channel_and_maybe_label)
-    pkg_name, version, _, _ = parse_filename(artifact)
 
     # Check existence
     url = (
         f"https://conda-web.anaconda.org/{channel_and_maybe_label}/{subdir}/{artifact}"
     )
-    r = requests.head(url)
+    r = get_session().head(url)
     if not r.ok:
         raise ValueError(f"Package '{package}' at {channel} does not seem to exist")
 
     # Check SHA256
-    r = requests.get(
-        f"https://api.anaconda.org/dist/{channel}/{pkg_name}/{version}/{subdir}/{artifact}",
-        timeout=10,
-    )
-    r.raise_for_status()
-    api_sha256 = r.json()["sha256"]
+    api_sha256 = _get_dist_sha256(package)
     if not hmac.compare_digest(sha256, api_sha256):
         raise ValueError(
             f"User-provided SHA256 {sha256} does not match expected value {api_sha256}"
         )
 
+    if deep_verify:
+        actual_sha256 = _hash_artifact(url)
+        if not hmac.compare_digest(actual_sha256, sha256) or not hmac.compare_digest(
+            actual_sha256, api_sha256
+        ):
+            raise ValueError(
+                f"SHA256 {actual_sha256} of the downloaded artifact does not match "
+                f"expected value {sha256}"
+            )
+
+
+def _verification_key(package: str, sha256: str, deep_verify: bool) -> tuple:
+    channel_and_maybe_label, subdir, artifact = package.rsplit("/", 2)
+    channel, label = split_label_from_channel(channel_and_maybe_label)
+    return (channel, label, subdir, artifact, sha256, deep_verify)
+
+
+def _is_verified(verified_artifacts, item, deep_verify):
+    # a deep verification also covers the regular one
+    return any(
+        _verification_key(item["package"], item["sha256"], deep) in verified_artifacts
+        for deep in {True, deep_verify}
+    )
+
+
+def verify_packages(
+    items: list[dict[str, str]], deep_verify: bool = False
+) -> dict[str, Exception | None]:
+    """Run `check_one` concurrently for the items not verified recently.
+
+    Returns a dict mapping each package to the exception raised while verifying
+    it, or None if it is valid.
+    """
+    verified_artifacts = _get_verified_artifacts()
+    results = {}
+    to_verify = []
+    for item in items:
+        if _is_verified(verified_artifacts, item, deep_verify):
+            results[item["package"]] = None
+        else:
+            to_verify.append(item)
+
+    for item, _, exc in map_concurrently(
+        lambda item: check_one(item["package"], item["sha256"], deep_verify),
+        to_verify,
+        max_workers=MAX_DEEP_VERIFY_WORKERS if deep_verify else DEFAULT_MAX_WORKERS,
+    ):
+        if exc is None:
+            verified_artifacts.add(
+                _verification_key(item["package"], item["sha256"], deep_verify)
+            )
+        results[item["package"]] = exc
+    return results
+
 
 def check(request: dict[str, object]) -> None:
     packages = request.get("anaconda_org_packages")
@@ -58,41 +164,91 @@ def check(request: dict[str, object]) -> None:
                 "Each 'anaconda_org_packages' entry must be a dict with keys "
                 "{'package': channel/subdir/artifact, 'sha256': SHA256}"
             )
-        check_one(item["package"], item["sha256"])
+    deep_verify = request.get("deep_verify", False)
+    if not isinstance(deep_verify, bool):
+        raise ValueError("'deep_verify' must be a boolean")
+
+    errors = [
+        f"{package}: {exc}"
+        for package, exc in verify_packages(packages, deep_verify).items()
+        if exc is not None
+    ]
+    if errors:
+        raise ValueError("Invalid artifacts:\n" + "\n".join(errors))
+
+
+def get_copy_api(token: str) -> Binstar:
+    """Return an anaconda.org client whose session pools and retries connections."""
+    api = Binstar(token=token)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=HTTP_RETRY,
+    )
+    api.session.mount("https://", adapter)
+    return api
+
+
+def copy_one(api: Binstar, package: str, to_label: str = "main") -> list[dict]:
+    """Copy one artifact to the conda-forge channel, like `anaconda copy`."""
+    channel_and_maybe_label, subdir, artifact = package.rsplit("/", 2)
+    channel, label = split_label_from_channel(channel_and_maybe_label)
+    pkg_name, version, _, _ = parse_filename(artifact)
+    return api.copy(
+        channel,
+        pkg_name,
+        version,
+        basename=f"{subdir}/{artifact}",
+        to_owner="conda-forge",
+        from_label=label,
+        to_label=to_label,
+    )
+
+
+def _copy_unchanged(api: Binstar, item: dict[str, str], to_label: str) -> list[dict]:
+    """Copy an artifact unless its SHA256 changed since it was verified.
+
+    The verification may be remembered or based on a cached response, so the
+    SHA256 is read again right before copying.
+    """
+    api_sha256 = _get_dist_sha256(item["package"], revalidate=True)
+    if not hmac.compare_digest(item["sha256"], api_sha256):
+        raise ValueError(
+            f"User-provided SHA256 {item['sha256']} does not match current value "
+            f"{api_sha256}"
+        )
+    return copy_one(api, item["package"], to_label)
 
 
 def run(request: dict[str, object]) -> dict[str, object] | None:
     if "PROD_BINSTAR_TOKEN" not in os.environ:
         return copy.deepcopy(request)
 
-    to_label = request.get("to_anaconda_org_label") or ()
-    if to_label:
-        to_label = ("--to-label", to_label)
+    to_label = request.get("to_anaconda_org_label") or "main"
     packages_to_try_again = []
+    to_copy = []
+    verification_errors = verify_packages(
+        request["anaconda_org_packages"], request.get("deep_verify", False)
+    )
     for item in request["anaconda_org_packages"]:
-        check_one(item["package"], item["sha256"])
-        channel_and_maybe_label, subdir, artifact = item["package"].rsplit("/", 2)
-        channel, label = split_label_from_channel(channel_and_maybe_label)
-        from_label = ("--from-label", label) if label != "main" else ()
-        pkg_name, version, _, _ = parse_filename(artifact)
-        spec = f"{channel}/{pkg_name}/{version}/{subdir}/{artifact}"
-        cmd = [
-            "anaconda",
-            "--token",
-            os.environ["PROD_BINSTAR_TOKEN"],
-            "copy",
-            "--to-owner",
-            "conda-forge",
-            *from_label,
-            *to_label,
-            spec,
-        ]
-        print("Copying", item["package"], "...")
-        p = subprocess.run(cmd)
-        if p.returncode == 0:
-            print("... OK!")
+        if verification_errors[item["package"]] is not None:
+            print(
+                f"Not copying {item['package']}: "
+                f"{verification_errors[item['package']]!r}"
+            )
+            packages_to_try_again.append(item)
+        else:
+            to_copy.append(item)
+
+    api = get_copy_api(os.environ["PROD_BINSTAR_TOKEN"])
+    for item, _, exc in map_concurrently(
+        lambda item: _copy_unchanged(api, item, to_label),
+        to_copy,
+        max_workers=MAX_COPY_WORKERS,
+    ):
+        if exc is None:
+            print("Copying", item["package"], "... OK!")
         else:
-            print("... failed!")
+            print("Copying", item["package"], f"... failed! {exc!r}")
             packages_to_try_again.append(item)
 
     if packages_to_try_again:
@@ -1,101 +1,362 @@
 from __future__ import annotations
 
 import copy
+import fnmatch
 import io
 import json
 import os
+import posixpath
+import re
+import tarfile
+import threading
 from textwrap import dedent
 
-import github
 import ruamel.yaml
 from conda_forge_metadata.feedstock_outputs import sharded_path as _get_sharded_path
 
-import requests
+from .utils import (
+    CACHE_DIR,
+    GH_ORG,
+    get_file_contents,
+    get_gh_headers,
+    get_missing_feedstocks,
+    get_session,
+    map_concurrently,
+    push_commit,
+    raise_json_for_status,
+)
 
+FEEDSTOCK_OUTPUTS_REPO = "feedstock-outputs"
+AUTOREG_ALLOWLIST_PATH = "feedstock_outputs_autoreg_allowlist.yml"
 
-def _test_and_raise_besides_file_not_exists(e: github.GithubException):
-    if isinstance(e, github.UnknownObjectException):
-        return
-    if e.status == 404 and "No object found" in e.data["message"]:
-        return
-    raise e
 
+def _is_glob(pkg_name):
+    return any(_c in pkg_name for _c in ["*", "?", "[", "]", "!"])
 
-def _add_feedstock_output(
-    feedstock,
-    pkg_name,
-):
-    gh_token = os.environ["GITHUB_TOKEN"]
-    gh = github.Github(auth=github.Auth.Token(gh_token))
-    repo = gh.get_repo("conda-forge/feedstock-outputs")
-    try:
-        contents = repo.get_contents(_get_sharded_path(pkg_name))
-    except github.GithubException as e:
-        _test_and_raise_besides_file_not_exists(e)
-        contents = None
-
-    if contents is None:
-        data = {"feedstocks": [feedstock]}
-        repo.create_file(
-            _get_sharded_path(pkg_name),
-            f"[cf admin skip] ***NO_CI*** add output {pkg_name} for conda-forge/{feedstock}-feedstock",
-            json.dumps(data),
-        )
-        print(
-            f"    output {pkg_name} added for feedstock conda-forge/{feedstock}-feedstock",
-            flush=True,
-        )
-    else:
-        data = json.loads(contents.decoded_content.decode("utf-8"))
-        if feedstock not in data["feedstocks"]:
-            data["feedstocks"].append(feedstock)
-            repo.update_file(
-                contents.path,
-                f"[cf admin skip] ***NO_CI*** add output {pkg_name} for conda-forge/{feedstock}-feedstock",
-                json.dumps(data),
-                contents.sha,
-            )
+
+def _add_globs(contents, globs, added):
+    """Add globs to the allowlist in a single parse and dump.
+
+    ``globs`` maps globs to the feedstocks to add them for. The ones actually
+    added are recorded in ``added``. Returns the new contents, or None if there
+    is nothing to change.
+    """
+    yaml = ruamel.yaml.YAML(typ="rt")  # use round-trip to preserve comments
+    data = yaml.load(contents or "{}")
+    for glob_str, feedstocks in globs.items():
+        for feedstock in feedstocks:
+            current_globs = data.get(feedstock, [])
+            if glob_str not in current_globs:
+                current_globs.append(glob_str)
+                added.setdefault(glob_str, []).append(feedstock)
+            data[feedstock] = current_globs
+    if not added:
+        return None
+    fp = io.StringIO()
+    yaml.dump(data, fp)
+    return fp.getvalue()
+
+
+def _add_feedstock_outputs(outputs: dict[str, list[str]]) -> dict[str, Exception]:
+    """Register outputs and globs for feedstocks in a single commit.
+
+    ``outputs`` maps output names or globs to the feedstocks to add for them.
+    All shards and the allowlist are read concurrently and every changed file
+    is written in the same commit. Returns a dict mapping the outputs and globs
+    whose file could not be read to the exception raised.
+    """
+    globs = {pkg_name: fs for pkg_name, fs in outputs.items() if _is_glob(pkg_name)}
+    names = {pkg_name: fs for pkg_name, fs in outputs.items() if pkg_name not in globs}
+    paths = [_get_sharded_path(pkg_name) for pkg_name in names]
+    if globs:
+        paths.append(AUTOREG_ALLOWLIST_PATH)
+    added = {}
+    failed = {}
+
+    def _get_changes(head_sha):
+        added.clear()
+        failed.clear()
+        files = {}
+        for path, contents, exc in map_concurrently(
+            lambda path: get_file_contents(FEEDSTOCK_OUTPUTS_REPO, path, head_sha),
+            paths,
+        ):
+            files[path] = exc if exc is not None else contents
+
+        changes = {}
+        for pkg_name, feedstocks in names.items():
+            contents = files[_get_sharded_path(pkg_name)]
+            if isinstance(contents, Exception):
+                failed[pkg_name] = contents
+                continue
+            data = {"feedstocks": []} if contents is None else json.loads(contents)
+            new_feedstocks = [
+                feedstock
+                for feedstock in feedstocks
+                if feedstock not in data["feedstocks"]
+            ]
+            if new_feedstocks:
+                data["feedstocks"].extend(new_feedstocks)
+                changes[_get_sharded_path(pkg_name)] = json.dumps(data)
+                added[pkg_name] = new_feedstocks
+
+        if globs:
+            contents = files[AUTOREG_ALLOWLIST_PATH]
+            if isinstance(contents, Exception):
+                failed.update(dict.fromkeys(globs, contents))
+            else:
+                contents = _add_globs(contents, globs, added)
+                if contents is not None:
+                    changes[AUTOREG_ALLOWLIST_PATH] = contents
+        return changes
+
+    feedstocks = sorted({f for feedstocks in outputs.values() for f in feedstocks})
+    message = "\n".join(
+        [
+            "[cf admin skip] ***NO_CI*** add outputs for "
+            + ", ".join(
+                f"conda-forge/{feedstock}-feedstock" for feedstock in feedstocks
+            ),
+            "",
+            *(
+                f"- {pkg_name}: {', '.join(pkg_feedstocks)}"
+                for pkg_name, pkg_feedstocks in outputs.items()
+            ),
+        ]
+    )
+    push_commit(FEEDSTOCK_OUTPUTS_REPO, message, get_changes=_get_changes)
+
+    for pkg_name, feedstocks in outputs.items():
+        if pkg_name in failed:
+            continue
+        for feedstock in feedstocks:
+            if feedstock in added.get(pkg_name, ()):
+                status = "added"
+            else:
+                status = "already exists"
             print(
-                f"    output {pkg_name} added for feedstock conda-forge/{feedstock}-feedstock",
+                f"    {'glob' if pkg_name in globs else 'output'} {pkg_name} {status} "
+                f"for feedstock conda-forge/{feedstock}-feedstock",
                 flush=True,
             )
+    return dict(failed)
+
+
+# The output index maps every registered output name to its feedstocks. It is
+# kept in CACHE_DIR and updated from the commits made since it was built, unless
+# too many files changed, in which case it is rebuilt from a tarball.
+OUTPUT_INDEX_FILENAME = "feedstock_outputs_index.json"
+OUTPUT_INDEX_MAX_CHANGED_FILES = 300
+
+# number of outputs of other feedstocks listed for each requested glob
+MAX_REPORTED_GLOB_CONFLICTS = 20
+
+_OUTPUT_INDEX = None
+_OUTPUT_INDEX_LOCK = threading.Lock()
+
+
+def _get_output_name(path):
+    # inverse of `sharded_path`: outputs/<c>/<c>/<c>/<name>.json
+    if not path.startswith("outputs/") or not path.endswith(".json"):
+        return None
+    return posixpath.basename(path)[: -len(".json")]
+
+
+def _get_feedstock_outputs_head():
+    r = get_session().get(
+        f"https://api.github.com/repos/{GH_ORG}/{FEEDSTOCK_OUTPUTS_REPO}/commits/main",
+        headers={**get_gh_headers(), "Accept": "application/vnd.github.sha"},
+    )
+    raise_json_for_status(r)
+    return r.text.strip()
+
+
+def _download_output_index(sha):
+    index = {}
+    with get_session().get(
+        f"https://api.github.com/repos/{GH_ORG}/{FEEDSTOCK_OUTPUTS_REPO}/tarball/{sha}",
+        headers=get_gh_headers(),
+        stream=True,
+    ) as r:
+        raise_json_for_status(r)
+        r.raw.decode_content = True
+        with tarfile.open(fileobj=r.raw, mode="r|gz") as tar:
+            for member in tar:
+                # strip the <owner>-<repo>-<sha>/ prefix
+                pkg_name = _get_output_name(member.name.partition("/")[2])
+                if pkg_name is not None and member.isfile():
+                    index[pkg_name] = json.load(tar.extractfile(member))["feedstocks"]
+    return index
+
+
+def _update_output_index(index, base, head):
+    """Apply the changes between two commits to ``index`` in place.
+
+    Returns False if the index has to be rebuilt instead.
+    """
+    r = get_session().get(
+        f"https://api.github.com/repos/{GH_ORG}/{FEEDSTOCK_OUTPUTS_REPO}"
+        f"/compare/{base}...{head}",
+        headers=get_gh_headers(),
+    )
+    if r.status_code == 404:
+        return False
+    raise_json_for_status(r)
+    comparison = r.json()
+    files = comparison.get("files", [])
+    if comparison["status"] != "ahead" or len(files) >= OUTPUT_INDEX_MAX_CHANGED_FILES:
+        return False
+
+    to_fetch = []
+    for file in files:
+        if file["status"] == "renamed":
+            index.pop(_get_output_name(file["previous_filename"]), None)
+        pkg_name = _get_output_name(file["filename"])
+        if pkg_name is None:
+            continue
+        if file["status"] == "removed":
+            index.pop(pkg_name, None)
         else:
+            to_fetch.append(file["filename"])
+
+    for path, contents, exc in map_concurrently(
+        lambda path: get_file_contents(FEEDSTOCK_OUTPUTS_REPO, path, head), to_fetch
+    ):
+        if exc is not None:
+            raise exc
+        if contents is None:
+            index.pop(_get_output_name(path), None)
+        else:
+            index[_get_output_name(path)] = json.loads(contents)["feedstocks"]
+    return True
+
+
+def _load_output_index(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return data["sha"], data["outputs"]
+    except (OSError, ValueError, KeyError):
+        return None, {}
+
+
+def _save_output_index(path, sha, index):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"sha": sha, "outputs": index}, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Not persisting the output index in {CACHE_DIR}: {e!r}", flush=True)
+
+
+def get_output_index() -> dict[str, list[str]]:
+    """Return a dict mapping each registered output name to its feedstocks.
+
+    The index is built once per process, from the copy saved in ``CACHE_DIR``
+    if it exists.
+    """
+    global _OUTPUT_INDEX
+
+    with _OUTPUT_INDEX_LOCK:
+        if _OUTPUT_INDEX is not None:
+            return _OUTPUT_INDEX
+
+        path = os.path.join(CACHE_DIR, OUTPUT_INDEX_FILENAME) if CACHE_DIR else None
+        sha, index = _load_output_index(path) if path else (None, {})
+        head = _get_feedstock_outputs_head()
+        if sha != head:
+            if sha is None or not _update_output_index(index, sha, head):
+                print(f"Building the output index at {head}", flush=True)
+                index = _download_output_index(head)
+            if path:
+                _save_output_index(path, head, index)
+        _OUTPUT_INDEX = index
+    return _OUTPUT_INDEX
+
+
+def match_globs(globs: list[str], names) -> dict[str, list[str]]:
+    """Return a dict mapping each glob to the names it matches.
+
+    The globs are compiled into a single regular expression, so names matching
+    none of them are discarded in one pass.
+    """
+    globs = list(dict.fromkeys(globs))
+    matches = {glob_str: [] for glob_str in globs}
+    if not globs:
+        return matches
+    patterns = {glob_str: fnmatch.translate(glob_str) for glob_str in globs}
+    any_glob = re.compile("|".join(patterns.values()))
+    compiled = {glob_str: re.compile(pattern) for glob_str, pattern in patterns.items()}
+    for name in names:
+        if not any_glob.match(name):
+            continue
+        for glob_str, pattern in compiled.items():
+            if pattern.match(name):
+                matches[glob_str].append(name)
+    return matches
+
+
+def _report_output_owners(mapping):
+    try:
+        index = get_output_index()
+    except Exception as e:
+        print(f"Could not look up the owners of the outputs: {e!r}", flush=True)
+        return
+
+    globs = {}
+    for feedstock, pkgs in mapping.items():
+        feedstock = feedstock.removesuffix("-feedstock")
+        for pkg_name in pkgs:
+            if _is_glob(pkg_name):
+                globs.setdefault(pkg_name, []).append(feedstock)
+                continue
+            owners = index.get(pkg_name)
+            if owners:
+                print(
+                    f"    output {pkg_name} is already registered for "
+                    + ", ".join(f"conda-forge/{f}-feedstock" for f in owners),
+                    flush=True,
+                )
+
+    for glob_str, names in match_globs(list(globs), index).items():
+        print(
+            f"    glob {glob_str} matches {len(names)} registered output(s)",
+            flush=True,
+        )
+        for feedstock in globs[glob_str]:
+            conflicts = [name for name in names if feedstock not in index[name]]
+            if not conflicts:
+                continue
             print(
-                f"    output {pkg_name} already exists for feedstock conda-forge/{feedstock}-feedstock",
+                f"    glob {glob_str} for conda-forge/{feedstock}-feedstock matches "
+                f"{len(conflicts)} output(s) of other feedstocks:",
                 flush=True,
             )
+            for name in conflicts[:MAX_REPORTED_GLOB_CONFLICTS]:
+                print(
+                    f"      {name} ("
+                    + ", ".join(f"conda-forge/{f}-feedstock" for f in index[name])
+                    + ")",
+                    flush=True,
+                )
+            if len(conflicts) > MAX_REPORTED_GLOB_CONFLICTS:
+                print(
+                    f"      ... and {len(conflicts) - MAX_REPORTED_GLOB_CONFLICTS} more",
+                    flush=True,
+                )
 
 
-def _add_feedstock_output_glob(
-    feedstock,
-    glob_str,
-):
-    gh_token = os.environ["GITHUB_TOKEN"]
-    gh = github.Github(auth=github.Auth.Token(gh_token))
-    repo = gh.get_repo("conda-forge/feedstock-outputs")
-    contents = repo.get_contents("feedstock_outputs_autoreg_allowlist.yml")
-
-    yaml = ruamel.yaml.YAML(typ="rt")  # use round-trip to preserve comments
-    data = yaml.load(contents.decoded_content.decode("utf-8"))
-    current_globs = data.get(feedstock, [])
-    if glob_str not in current_globs:
-        current_globs.append(glob_str)
-    data[feedstock] = current_globs
-    fp = io.StringIO()
-    yaml.dump(data, fp)
-    repo.update_file(
-        contents.path,
-        f"[cf admin skip] ***NO_CI*** add glob {glob_str} for conda-forge/{feedstock}-feedstock",
-        fp.getvalue(),
-        contents.sha,
-    )
-    print(
-        f"    glob {glob_str} added for feedstock conda-forge/{feedstock}-feedstock",
-        flush=True,
-    )
+def get_locks(request):
+    # all requests commit to the same branch of conda-forge/feedstock-outputs
+    feedstocks = request.get("feedstock_to_output_mapping") or {}
+    return {
+        "conda-forge/feedstock-outputs",
+        *(str(feedstock).removesuffix("-feedstock") for feedstock in feedstocks),
+    }
 
 
-def check(request):
+def _check_request(request):
     action = request["action"]
     assert action == "add_feedstock_output"
 
@@ -103,12 +364,19 @@ def check(request):
     msg = "feedstock to output mapping syntax has changed and requires a dictionary now. See example."
     assert isinstance(request["feedstock_to_output_mapping"], dict), msg
 
+    missing_feedstocks = get_missing_feedstocks(
+        [
+            feedstock.removesuffix("-feedstock")
+            for feedstock in request["feedstock_to_output_mapping"]
+        ]
+    )
+    if missing_feedstocks:
+        raise RuntimeError(f"feedstocks {missing_feedstocks} could not be found!")
+
     for feedstock, pkgs in request["feedstock_to_output_mapping"].items():
         if feedstock.endswith("-feedstock"):
             feedstock = feedstock[:-10]
 
-        r = requests.head(f"https://github.com/conda-forge/{feedstock}-feedstock")
-        r.raise_for_status()
         if not isinstance(pkgs, list):
             raise ValueError(dedent(f"""\
                     Value for '{feedstock}' entry must be a list of str (output name, or a glob),
@@ -136,31 +404,38 @@ def check(request):
                 )
 
 
+def check(request):
+    _check_request(request)
+    # only informs the reviewers of the request, so `run` skips it
+    _report_output_owners(request["feedstock_to_output_mapping"])
+
+
 def run(request: dict[str, object]) -> dict[str, object] | None:
-    check(request)
+    _check_request(request)
     action = request["action"]
     assert action == "add_feedstock_output"
 
     assert request.get("feedstock_to_output_mapping")
     items_to_keep = {}
+    outputs = {}
     for feedstock, pkgs in request["feedstock_to_output_mapping"].items():
         if feedstock.endswith("-feedstock"):
             feedstock = feedstock[:-10]
-        pkgs_to_keep = []
         for pkg_name in pkgs:
-            try:
-                if any(_c in pkg_name for _c in ["*", "?", "[", "]", "!"]):
-                    _add_feedstock_output_glob(feedstock, pkg_name)
-                else:
-                    _add_feedstock_output(feedstock, pkg_name)
-            except Exception as e:
+            outputs.setdefault(pkg_name, []).append(feedstock)
+
+    if outputs:
+        try:
+            failed = _add_feedstock_outputs(outputs)
+        except Exception as e:
+            failed = dict.fromkeys(outputs, e)
+        for pkg_name, e in failed.items():
+            for feedstock in outputs[pkg_name]:
                 print(
                     f"    could not add output {pkg_name} for feedstock conda-forge/{feedstock}-feedstock: {e}",
                     flush=True,
                 )
-                pkgs_to_keep.append(pkg_name)
-        if pkgs_to_keep:
-            items_to_keep[feedstock] = pkgs_to_keep
+                items_to_keep.setdefault(feedstock, []).append(pkg_name)
 
     if items_to_keep:
         request = copy.deepcopy(request)
@@ -168,3 +443,17 @@ def run(request: dict[str, object]) -> dict[str, object] | None:
         return request
     else:
         return None
+
+
+def finalize(results):
+    """Bring the output index in ``CACHE_DIR`` up to date with this run's commits.
+
+    The workflow saves the index, so that `check` only has to apply the commits
+    made since. The results of the requests are not updated.
+    """
+    try:
+        get_output_index()
+    except Exception as e:
+        # the index is only a cache, `check` rebuilds it if needed
+        print(f"::warning::Could not update the output index: {e!r}", flush=True)
+    return {}
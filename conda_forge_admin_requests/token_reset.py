@@ -5,19 +5,23 @@ import os
 import subprocess
 import tempfile
 
-import github
+from .utils import (
+    SMITHY_CONF,
+    get_gh_headers,
+    get_missing_feedstocks,
+    get_session,
+    raise_json_for_status,
+    write_secrets_to_files,
+)
 
-import requests
-
-from .utils import write_secrets_to_files
-
-FEEDSTOCK_TOKENS_REPO = None
+FEEDSTOCK_TOKENS_CONTENTS_URL = (
+    "https://api.github.com/repos/conda-forge/feedstock-tokens/contents/tokens"
+)
 
 
 def feedstock_token_exists(feedstock_name):
-    r = requests.get(
-        "https://api.github.com/repos/conda-forge/"
-        "feedstock-tokens/contents/tokens/%s.json" % (feedstock_name),
+    r = get_session().get(
+        "%s/%s.json" % (FEEDSTOCK_TOKENS_CONTENTS_URL, feedstock_name),
         headers={"Authorization": "token %s" % os.environ["GITHUB_TOKEN"]},
     )
     if r.status_code != 200:
@@ -26,33 +30,27 @@ def feedstock_token_exists(feedstock_name):
         return True
 
 
-def get_feedstock_token_repo():
-    global FEEDSTOCK_TOKENS_REPO
-
+def delete_feedstock_token(feedstock_name):
     if "GITHUB_TOKEN" not in os.environ:
         raise RuntimeError(
             "Cannot delete feedstock token since " "we do not have a github token!"
         )
 
-    if FEEDSTOCK_TOKENS_REPO is None:
-        FEEDSTOCK_TOKENS_REPO = github.Github(os.environ["GITHUB_TOKEN"]).get_repo(
-            "conda-forge/feedstock-tokens"
-        )
-
-    return FEEDSTOCK_TOKENS_REPO
-
-
-def delete_feedstock_token(feedstock_name):
-    feedstock_tokens_repo = get_feedstock_token_repo()
-
-    token_file = "tokens/%s.json" % feedstock_name
-    fn = feedstock_tokens_repo.get_contents(token_file)
-    feedstock_tokens_repo.delete_file(
-        token_file,
-        "[ci skip] [skip ci] [cf admin skip] ***NO_CI*** removing "
-        "token for %s" % feedstock_name,
-        fn.sha,
+    session = get_session()
+    headers = get_gh_headers()
+    token_url = "%s/%s.json" % (FEEDSTOCK_TOKENS_CONTENTS_URL, feedstock_name)
+    r = session.get(token_url, headers=headers)
+    raise_json_for_status(r)
+    r = session.delete(
+        token_url,
+        headers=headers,
+        json={
+            "message": "[ci skip] [skip ci] [cf admin skip] ***NO_CI*** removing "
+            "token for %s" % feedstock_name,
+            "sha": r.json()["sha"],
+        },
     )
+    raise_json_for_status(r)
 
 
 def reset_feedstock_token(
@@ -194,15 +192,15 @@ def run(request: dict[str, object]) -> dict[str, object] | None:
         return None
 
 
+def get_locks(request):
+    # write_secrets_to_files() rewrites the shared token files of conda-smithy
+    return {SMITHY_CONF, *request.get("feedstocks", [])}
+
+
 def check(request):
     assert "feedstocks" in request
     feedstocks = request["feedstocks"]
-    missing_feedstocks = []
-
-    for feedstock in feedstocks:
-        r = requests.get(f"https://github.com/conda-forge/{feedstock}-feedstock")
-        if r.status_code != 200:
-            missing_feedstocks.append(feedstock)
+    missing_feedstocks = get_missing_feedstocks(feedstocks)
 
     if missing_feedstocks:
         raise RuntimeError(f"feedstocks {missing_feedstocks} could not be found!")
@@ -1,11 +1,484 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple
 
 from conda_build.utils import create_file_with_permissions
+from urllib3.util.retry import Retry
+
+import requests
 
 SMITHY_CONF = os.path.expanduser("~/.conda-smithy")
 
 GH_ORG = os.environ.get("GH_ORG", "conda-forge")
 
+# Requests holding this lock (see `get_locks` in the action modules) are run
+# alone, without any other request in flight.
+EXCLUSIVE_LOCK = "*"
+
+# (connect, read) timeouts in seconds used by the shared session unless the
+# caller passes its own
+DEFAULT_TIMEOUT = (10, 60)
+
+# Transient failures are retried with exponential backoff. Responses with a
+# retryable status are only retried for idempotent methods (urllib3's default
+# allowed_methods), while connection errors are retried for all of them since
+# the request never reached the server. The last response is returned as is
+# if all attempts fail, so callers keep checking the status themselves.
+HTTP_RETRY = Retry(
+    total=5,
+    connect=3,
+    read=2,
+    status=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# maximum number of keep-alive connections kept per host
+HTTP_POOL_MAXSIZE = 32
+
+# Directory for data persisted across runs; set it to an empty string to
+# disable all on-disk caches.
+CACHE_DIR = os.environ.get(
+    "CF_ADMIN_REQUESTS_CACHE_DIR",
+    os.path.expanduser("~/.cache/conda-forge-admin-requests"),
+)
+
+# Time to live in seconds of cached GET responses, by URL prefix. Only URLs
+# matching one of the prefixes are cached. Expired responses that came with an
+# ETag are revalidated with If-None-Match, so a TTL of 0 means "always
+# revalidate". Unchanged resources then cost a 304, which does not count
+# against GitHub's rate limit. Requests sent with ``Cache-Control: no-cache``
+# are always revalidated.
+HTTP_CACHE_TTLS = (
+    # artifact metadata (incl. its SHA256) only changes if it is re-uploaded
+    ("https://api.anaconda.org/dist/", 3600),
+    ("https://api.github.com/repos/", 0),
+)
+
+# least recently used responses are evicted beyond this size
+HTTP_CACHE_MAX_BYTES = 64 * 1024**2
+
+# Calls to the GitHub API are spread out by a token bucket refilling at this
+# rate (per second), which allows bursts of up to GITHUB_BURST calls.
+GITHUB_CALLS_PER_SECOND = 10
+GITHUB_BURST = 20
+
+# Low priority calls (retries of failed requests) are deferred once the
+# remaining budget of a rate limit resource drops to this reserve, which is kept
+# for new work.
+GITHUB_LOW_PRIORITY_RESERVE = {"core": 500, "graphql": 500}
+
+# High priority calls wait for the rate limit to reset if it is exhausted, as
+# long as that happens within this many seconds.
+GITHUB_MAX_RATE_LIMIT_WAIT = 10 * 60
+
+_GITHUB_PRIORITY = contextvars.ContextVar("github_priority", default="high")
+
+
+class RateLimitDeferred(RuntimeError):
+    """Raised instead of calling the GitHub API when the rate limit budget is
+    too low for the current priority. The work should be retried later."""
+
+
+@contextlib.contextmanager
+def github_low_priority():
+    """Mark the GitHub API calls made in this context as low priority."""
+    token = _GITHUB_PRIORITY.set("low")
+    try:
+        yield
+    finally:
+        _GITHUB_PRIORITY.reset(token)
+
+
+class GitHubRateLimiter:
+    """Admit calls to the GitHub API based on the remaining rate limit budget.
+
+    The budget of each resource (``core``, ``graphql``, ...) is tracked from the
+    ``X-RateLimit-*`` headers of the responses and decremented for every call
+    admitted in between.
+    """
+
+    def __init__(
+        self,
+        rate=GITHUB_CALLS_PER_SECOND,
+        burst=GITHUB_BURST,
+        reserve=GITHUB_LOW_PRIORITY_RESERVE,
+        max_wait=GITHUB_MAX_RATE_LIMIT_WAIT,
+    ):
+        self._rate = rate
+        self._burst = burst
+        self._reserve = reserve
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        # resource -> [remaining, reset timestamp]
+        self._budgets = {}
+
+    def acquire(self, resource, priority="high"):
+        while True:
+            with self._lock:
+                delay = self._check_budget(resource, priority)
+                if delay == 0:
+                    delay = self._take_token()
+                if delay == 0:
+                    budget = self._budgets.get(resource)
+                    if budget is not None:
+                        budget[0] -= 1
+                    return
+            time.sleep(delay)
+
+    def _check_budget(self, resource, priority):
+        budget = self._budgets.get(resource)
+        if budget is None:
+            return 0
+        remaining, reset = budget
+        wait = reset - time.time()
+        if wait <= 0:
+            # a new window started, the next response tells us its budget
+            del self._budgets[resource]
+            return 0
+        if priority == "low" and remaining <= self._reserve.get(resource, 0):
+            raise RateLimitDeferred(
+                f"Only {remaining} GitHub API calls left for '{resource}' until "
+                f"{time.ctime(reset)}, deferring low priority work"
+            )
+        if remaining > 0:
+            return 0
+        if wait > self._max_wait:
+            raise RateLimitDeferred(
+                f"GitHub API rate limit for '{resource}' exhausted until "
+                f"{time.ctime(reset)}"
+            )
+        print(
+            f"GitHub API rate limit for '{resource}' exhausted, "
+            f"sleeping {wait:.0f}s until it resets",
+            flush=True,
+        )
+        return wait + 1
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._refilled_at) * self._rate
+        )
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def update(self, response):
+        headers = response.headers
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = int(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        resource = headers.get("X-RateLimit-Resource", "core")
+        with self._lock:
+            self._budgets[resource] = [remaining, reset]
+
+
+GITHUB_RATE_LIMITER = GitHubRateLimiter()
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+class _CachedResponse(NamedTuple):
+    status: int
+    headers: str
+    body: bytes
+    etag: str | None
+    stored_at: float
+
+    def to_response(self, request):
+        response = requests.Response()
+        response.status_code = self.status
+        response.reason = "OK"
+        response.headers = requests.structures.CaseInsensitiveDict(
+            json.loads(self.headers)
+        )
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = self.body
+        response.url = request.url
+        response.request = request
+        return response
+
+
+class _HTTPCache:
+    """SQLite-backed store of GET responses with LRU eviction."""
+
+    def __init__(self, path, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT, "
+            "body BLOB, etag TEXT, stored_at REAL, accessed_at REAL, size INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_url ON responses (url)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, headers, body, etag, stored_at FROM responses "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return _CachedResponse(*row)
+
+    def put(self, key, url, response):
+        headers = json.dumps(dict(response.headers))
+        size = len(response.content) + len(headers)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    url,
+                    response.status_code,
+                    headers,
+                    response.content,
+                    response.headers.get("ETag"),
+                    now,
+                    now,
+                    size,
+                ),
+            )
+            self._evict()
+
+    def touch(self, key):
+        """Mark a response as fresh again after a successful revalidation."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE responses SET stored_at = ? WHERE key = ?", (time.time(), key)
+            )
+
+    def invalidate(self, url):
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+
+    def _evict(self):
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= self._max_bytes:
+            return
+        stale = []
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self._max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+
+def _open_http_cache():
+    if not CACHE_DIR:
+        return None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        return _HTTPCache(os.path.join(CACHE_DIR, "http.sqlite"))
+    except (OSError, sqlite3.Error) as e:
+        print(f"Not using the HTTP cache in {CACHE_DIR}: {e!r}", flush=True)
+        return None
+
+
+class ExpiringStore:
+    """Set of keys that expire ``ttl`` seconds after being added.
+
+    The keys are persisted across runs in ``CACHE_DIR/<name>.sqlite``, or kept
+    in memory if on-disk caches are disabled. Keys are tuples of JSON values.
+    """
+
+    def __init__(self, name, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        path = ":memory:"
+        if CACHE_DIR:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                path = os.path.join(CACHE_DIR, f"{name}.sqlite")
+            except OSError as e:
+                print(f"Not persisting {name} in {CACHE_DIR}: {e!r}", flush=True)
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, added_at REAL)"
+        )
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT added_at FROM entries WHERE key = ?", (json.dumps(key),)
+            ).fetchone()
+        return row is not None and time.time() - row[0] < self._ttl
+
+    def add(self, key):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?)", (json.dumps(key), now)
+            )
+            self._db.execute(
+                "DELETE FROM entries WHERE added_at < ?", (now - self._ttl,)
+            )
+
+
+def _get_cache_ttl(url):
+    for prefix, ttl in HTTP_CACHE_TTLS:
+        if url.startswith(prefix):
+            return ttl
+    return None
+
+
+def _get_cache_key(request, ttl):
+    # Responses may depend on who is asking and for which media type. Entries
+    # that are always revalidated are shared across credentials (e.g. the
+    # short-lived tokens of each CI run), since the server checks the ETag
+    # with the current ones.
+    parts = (
+        request.url,
+        request.headers.get("Authorization", "") if ttl > 0 else "",
+        request.headers.get("Accept", ""),
+    )
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class _Session(requests.Session):
+    def __init__(self, cache=None, rate_limiter=None):
+        super().__init__()
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+    def _send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        if self.rate_limiter is None or url.hostname != "api.github.com":
+            return super().send(request, **kwargs)
+
+        resource = "graphql" if url.path == "/graphql" else "core"
+        self.rate_limiter.acquire(resource, _GITHUB_PRIORITY.get())
+        response = super().send(request, **kwargs)
+        self.rate_limiter.update(response)
+        return response
+
+    def send(self, request, **kwargs):
+        if self.cache is None or kwargs.get("stream"):
+            return self._send(request, **kwargs)
+
+        if request.method not in ("GET", "HEAD"):
+            response = self._send(request, **kwargs)
+            self.cache.invalidate(request.url)
+            return response
+
+        ttl = _get_cache_ttl(request.url)
+        if request.method != "GET" or ttl is None:
+            return self._send(request, **kwargs)
+
+        key = _get_cache_key(request, ttl)
+        cached = self.cache.get(key)
+        if "no-cache" in request.headers.get("Cache-Control", ""):
+            ttl = 0
+        if cached is not None:
+            if time.time() - cached.stored_at < ttl:
+                return cached.to_response(request)
+            if cached.etag:
+                request.headers["If-None-Match"] = cached.etag
+
+        response = self._send(request, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(key)
+            return cached.to_response(request)
+        if response.status_code == 200:
+            self.cache.put(key, request.url, response)
+        return response
+
+
+def get_session() -> requests.Session:
+    """Return the HTTP session shared by all actions.
+
+    The session keeps connections alive in per-host pools, applies
+    `DEFAULT_TIMEOUT` and retries transient failures according to `HTTP_RETRY`.
+    GET responses are cached on disk according to `HTTP_CACHE_TTLS` and calls to
+    the GitHub API are admitted by `GITHUB_RATE_LIMITER`. It is safe to use from
+    several threads.
+    """
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = _Session(
+                cache=_open_http_cache(), rate_limiter=GITHUB_RATE_LIMITER
+            )
+            session.headers["User-Agent"] = "conda-forge/admin-requests"
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                max_retries=HTTP_RETRY,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSION = session
+    return _SESSION
+
+
+# default size of the thread pools used to run network calls concurrently
+DEFAULT_MAX_WORKERS = 8
+
+
+def map_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """Call ``func`` on each of ``items`` on a bounded thread pool.
+
+    Returns a list of ``(item, result, exception)`` tuples in the order of
+    ``items``, where ``exception`` is None if the call succeeded. The calling
+    context (e.g. the priority of GitHub API calls) is propagated to the calls.
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, func, item)
+            for item in items
+        ]
+    results = []
+    for item, future in zip(items, futures):
+        try:
+            results.append((item, future.result(), None))
+        except Exception as e:
+            results.append((item, None, e))
+    return results
+
 
 def get_gh_headers():
     headers = {
@@ -25,6 +498,196 @@ def raise_json_for_status(request):
         raise exc.with_traceback(exc.__traceback__)
 
 
+def _post_graphql(query, variables, previews=()):
+    headers = get_gh_headers()
+    if previews:
+        # schema previews are enabled by their custom media types
+        accept = [f"application/vnd.github.{name}-preview+json" for name in previews]
+        headers["Accept"] = ", ".join([*accept, headers["Accept"]])
+    r = get_session().post(
+        "https://api.github.com/graphql",
+        headers=headers,
+        json={"query": query, "variables": variables or {}},
+    )
+    raise_json_for_status(r)
+    return r.json()
+
+
+def run_graphql(
+    query: str, variables: dict | None = None, previews: tuple[str, ...] = ()
+) -> dict:
+    """Run a query against the GitHub GraphQL API and return its ``data``.
+
+    ``previews`` are the names of the schema previews the query needs, e.g.
+    ``update-refs``. Raises if the HTTP request fails or if the response
+    contains errors other than ``NOT_FOUND``, for which the corresponding field
+    is ``None``.
+    """
+    payload = _post_graphql(query, variables, previews)
+    errors = [
+        error for error in payload.get("errors", []) if error.get("type") != "NOT_FOUND"
+    ]
+    if errors or payload.get("data") is None:
+        raise RuntimeError(f"GraphQL query failed: {errors or payload}")
+    return payload["data"]
+
+
+def run_graphql_aliases(
+    query: str, variables: dict | None = None
+) -> tuple[dict, dict[str, list[dict]]]:
+    """Run a GraphQL query or mutation made of several aliased fields.
+
+    Unlike `run_graphql`, errors of individual fields do not fail the whole
+    call. Returns the ``data`` and a dict mapping the aliases of the fields
+    that failed to their errors.
+    """
+    payload = _post_graphql(query, variables)
+    errors = {}
+    for error in payload.get("errors", []):
+        if not error.get("path"):
+            raise RuntimeError(f"GraphQL query failed: {payload['errors']}")
+        errors.setdefault(error["path"][0], []).append(error)
+    return payload.get("data") or {}, errors
+
+
+def get_file_contents(repo: str, path: str, ref: str) -> str | None:
+    """Return the contents of a file of ``GH_ORG/repo`` at ``ref``, or None if
+    the file does not exist."""
+    r = get_session().get(
+        f"https://api.github.com/repos/{GH_ORG}/{repo}/contents/{path}",
+        headers={**get_gh_headers(), "Accept": "application/vnd.github.raw+json"},
+        params={"ref": ref},
+    )
+    if r.status_code == 404:
+        return None
+    raise_json_for_status(r)
+    return r.text
+
+
+# number of times a commit is rebuilt on top of a branch head that moved
+PUSH_COMMIT_ATTEMPTS = 5
+
+
+def push_commit(
+    repo: str,
+    message: str,
+    branch: str = "main",
+    get_changes: Callable[[str], dict[str, str]] | None = None,
+) -> str | None:
+    """Push a commit to a branch of ``GH_ORG/repo`` without a checkout.
+
+    The commit is created through the Git Data API. Without ``get_changes`` it
+    is empty, reusing the tree of the branch head. Otherwise,
+    ``get_changes(head_sha)`` must return a dict mapping paths to their new
+    contents, computed from the files at ``head_sha``. If the branch moves
+    before the commit lands, the changes are computed again on top of the new
+    head. Returns the SHA of the new commit, or None if there was nothing to
+    change.
+    """
+    session = get_session()
+    headers = get_gh_headers()
+    api_url = f"https://api.github.com/repos/{GH_ORG}/{repo}"
+
+    for attempt in range(PUSH_COMMIT_ATTEMPTS):
+        r = session.get(f"{api_url}/branches/{branch}", headers=headers)
+        raise_json_for_status(r)
+        head = r.json()["commit"]
+        tree_sha = head["commit"]["tree"]["sha"]
+
+        if get_changes is not None:
+            changes = get_changes(head["sha"])
+            if not changes:
+                return None
+            r = session.post(
+                f"{api_url}/git/trees",
+                headers=headers,
+                json={
+                    "base_tree": tree_sha,
+                    "tree": [
+                        {
+                            "path": path,
+                            "mode": "100644",
+                            "type": "blob",
+                            "content": content,
+                        }
+                        for path, content in changes.items()
+                    ],
+                },
+            )
+            raise_json_for_status(r)
+            tree_sha = r.json()["sha"]
+
+        r = session.post(
+            f"{api_url}/git/commits",
+            headers=headers,
+            json={"message": message, "tree": tree_sha, "parents": [head["sha"]]},
+        )
+        raise_json_for_status(r)
+        commit_sha = r.json()["sha"]
+
+        r = session.patch(
+            f"{api_url}/git/refs/heads/{branch}",
+            headers=headers,
+            json={"sha": commit_sha, "force": False},
+        )
+        if r.status_code == 422 and attempt + 1 < PUSH_COMMIT_ATTEMPTS:
+            # not a fast-forward: someone else pushed in the meantime
+            print(f"{GH_ORG}/{repo}@{branch} moved, retrying commit", flush=True)
+            continue
+        raise_json_for_status(r)
+        return commit_sha
+
+
+# maximum number of aliased fields queried in a single GraphQL request
+GRAPHQL_BATCH_SIZE = 100
+
+
+def get_feedstock_repos(
+    feedstocks: list[str], owner: str = GH_ORG
+) -> dict[str, dict | None]:
+    """Look up the repositories of several feedstocks with batched GraphQL queries.
+
+    ``feedstocks`` are given without the ``-feedstock`` suffix. Returns a mapping
+    from each feedstock to ``None`` if its repository does not exist, or else to
+    a dict with the keys ``id`` (GraphQL node ID), ``archived`` and
+    ``default_branch``.
+    """
+    feedstocks = list(dict.fromkeys(feedstocks))
+    repos = {}
+    for start in range(0, len(feedstocks), GRAPHQL_BATCH_SIZE):
+        batch = feedstocks[start : start + GRAPHQL_BATCH_SIZE]
+        params = ", ".join(f"$n{i}: String!" for i in range(len(batch)))
+        fields = "\n".join(
+            f"r{i}: repository(owner: $owner, name: $n{i}) "
+            "{ id isArchived defaultBranchRef { name } }"
+            for i in range(len(batch))
+        )
+        variables = {"owner": owner}
+        variables.update(
+            {f"n{i}": f"{feedstock}-feedstock" for i, feedstock in enumerate(batch)}
+        )
+        data = run_graphql(
+            f"query($owner: String!, {params}) {{\n{fields}\n}}", variables
+        )
+        for i, feedstock in enumerate(batch):
+            repo = data.get(f"r{i}")
+            if repo is None:
+                repos[feedstock] = None
+            else:
+                repos[feedstock] = {
+                    "id": repo["id"],
+                    "archived": repo["isArchived"],
+                    "default_branch": (repo["defaultBranchRef"] or {}).get("name"),
+                }
+    return repos
+
+
+def get_missing_feedstocks(feedstocks: list[str]) -> list[str]:
+    """Return the feedstocks (without ``-feedstock`` suffix) that do not exist."""
+    repos = get_feedstock_repos(feedstocks)
+    return [feedstock for feedstock, repo in repos.items() if repo is None]
+
+
 def _write_token(name, token):
     path = os.path.join(SMITHY_CONF, name + ".token")
     with create_file_with_permissions(path, 0o600) as fh: